@@ -1,35 +1,77 @@
+import asyncio
+import functools
+import hashlib
 import importlib
+import itertools
+import json
 import logging
+import operator
+import random
+import select
 import signal
 import sys
+import threading
 import traceback
 import time
+import warnings
+from collections import (
+    OrderedDict,
+    defaultdict,
+)
 from concurrent.futures import (
     ThreadPoolExecutor,
     as_completed,
 )
-from datetime import datetime
-from logging.handlers import WatchedFileHandler
 
 from slackclient import SlackClient
+from slackclient.server import SlackConnectionError
+from websocket import WebSocketConnectionClosedException
 
 
 """
 Slack API list: https://api.slack.com/bot-users#api_usage
 """
 
+# Error reports posted back to Slack are cut to this many characters, leaving room
+# for the default method's own text within Slack's 4000 character message limit.
+MAX_ERROR_MESSAGE_LENGTH = 2500
+MAX_ERROR_TRACEBACK_FRAMES = 20
+
+# Slack recommends paginating users.list with no more than 200 members per page.
+USERS_LIST_PAGE_SIZE = 200
+
+# How long a bot id cached on disk is trusted before users.list is paged again.
+BOT_ID_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Exponential backoff between RTM reconnection attempts, in seconds.
+RECONNECT_BACKOFF_BASE = 1
+RECONNECT_BACKOFF_MAX = 60
+# auth.test errors after which reconnecting can never succeed.
+UNRECOVERABLE_AUTH_ERRORS = ('invalid_auth', 'not_authed', 'account_inactive', 'token_revoked')
+
+# Errors raised by a dropped RTM connection.
+RTM_CONNECTION_ERRORS = (SlackConnectionError, WebSocketConnectionClosedException, ConnectionError)
+
 
 class SlackMethod:
     """
     Base Class of User's command.
     """
 
+    # Empty, so subclasses that also declare `__slots__ = ()` carry no instance __dict__.
+    # Subclasses without it keep a __dict__ as usual.
+    __slots__ = ()
+
     @property
     def execution_words(self):
-        """This method should be able to return list(str).
+        """This method should be able to return list(str) or tuple(str).
+
+        A plain class attribute, e.g. `execution_words = ('test', 'ping')`, works as well.
+        Words must be plain strings. They are stripped and lowercased once at registration,
+        and matched case-insensitively against the first word of a command.
 
         Returns
-            list(str): The keywords to execute the method `response`.
+            list(str) or tuple(str): The keywords to execute the method `response`.
         """
         raise NotImplementedError()
 
@@ -45,6 +87,9 @@ class SlackMethod:
     def response(self, channel, thread_ts, user_command, request_user):
         """This method should be able to return a str response
 
+        It may also be a coroutine function. It is then awaited on an event loop owned by the worker thread,
+        so a single command can wait on several HTTP calls concurrently.
+
         Args:
             channel (str): Channel with requested user
             thread_ts (str): Thread requested from user
@@ -54,25 +99,129 @@ class SlackMethod:
         Returns:
             (str): Target channel
             (str): Target thread or None
-            (str|list): Message to send
+            (str|list): Message to send. A list of blocks, or a list of str sent as one section block each.
         """
         raise NotImplementedError()
 
 
+@functools.lru_cache(maxsize=None)
+def _import_by_name(name):
+    module_string, attr_path = name.rsplit(':', 1)
+    module = importlib.import_module(module_string)
+    return operator.attrgetter(attr_path)(module)
+
+
+def _normalize_triggers(execution_words):
+    # Words that only differ in case or spacing collapse into one trigger, in first-seen order.
+    return tuple(OrderedDict.fromkeys(word.strip().lower() for word in execution_words if isinstance(word, str)))
+
+
 def load_function(func):
-    if hasattr(func, '__call__'):
-        func = func
+    if callable(func):
+        pass
     elif isinstance(func, str):
-        module_string, func_name = func.split(':')
-        module = importlib.import_module(module_string)
-        func = getattr(module, func_name)
+        func = _import_by_name(func)
     else:
         raise TypeError("A type of \"func\" argument is must function or str. "
                         "When put str, it must be full name of function. "
-                        "e.g.: func=\"moduleA.moduleB:function_name\"")
+                        "e.g.: func=\"moduleA.moduleB:function_name\" or \"moduleA:ClassName.method_name\"")
     return func
 
 
+class SlackMethodEntry(object):
+    """
+    What the bot keeps of a registered `SlackMethod`.
+    """
+
+    __slots__ = ('class_name', 'triggers', 'help_text', 'response')
+
+    def __init__(self, class_name, triggers, help_text, response):
+        self.class_name = class_name
+        self.triggers = triggers
+        self.help_text = help_text
+        self.response = response
+
+    def __repr__(self):
+        return '<SlackMethodEntry {}: {}>'.format(self.class_name, self.triggers)
+
+
+class RateLimiter(object):
+    """
+    Token buckets in front of Slack Web API calls, one per API method, sized by the method's rate limit tier.
+    Posting methods are limited per channel instead, as Slack does.
+    A call waits for a token instead of being rejected by Slack, and a `ratelimited` response is retried
+    after the `Retry-After` seconds Slack asks for.
+
+    Rate limits: https://api.slack.com/docs/rate-limits
+    """
+
+    # Requests per minute of each tier.
+    TIER_RATES = {1: 1, 2: 20, 3: 50, 4: 100}
+    METHOD_TIERS = {
+        'auth.test': 4,
+        'users.info': 4,
+        'users.list': 2,
+    }
+    DEFAULT_TIER = 3
+    # Posting is limited to about one message per second per channel, with short bursts allowed.
+    PER_CHANNEL_METHODS = ('chat.postMessage',)
+    CHANNEL_RATE = 1
+    CHANNEL_BURST = 5
+
+    def __init__(self, api_call, max_retries=3):
+        self._api_call = api_call
+        self.max_retries = max_retries
+        # API method, or (API method, channel) -> [tokens, last refill]
+        self._buckets = dict()
+        self._lock = threading.Lock()
+
+    def __call__(self, method, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.acquire(method, kwargs.get('channel'))
+            response = self._api_call(method, **kwargs)
+
+            if response.get('error') != 'ratelimited' or attempt == self.max_retries:
+                return response
+
+            time.sleep(self._retry_after(response))
+
+    @staticmethod
+    def _retry_after(response):
+        # slackclient copies the HTTP headers into a plain dict, so the name's case is whatever Slack sent.
+        for name, value in response.get('headers', {}).items():
+            if name.lower() == 'retry-after':
+                try:
+                    return int(value)
+                except (TypeError, ValueError):
+                    break
+
+        return 1
+
+    def acquire(self, method, channel=None):
+        if method in self.PER_CHANNEL_METHODS and channel is not None:
+            self._take((method, channel), self.CHANNEL_BURST, self.CHANNEL_RATE)
+            return
+
+        rate = self.TIER_RATES[self.METHOD_TIERS.get(method, self.DEFAULT_TIER)]
+        self._take(method, rate, rate / 60)
+
+    def _take(self, key, capacity, tokens_per_second):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket = self._buckets.setdefault(key, [capacity, now])
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * tokens_per_second)
+                bucket[1] = now
+
+                if bucket[0] >= 1:
+                    bucket[0] -= 1
+                    return
+
+                wait = (1 - bucket[0]) / tokens_per_second
+
+            time.sleep(wait)
+
+
 class DefaultMethod(SlackMethod):
 
     @property
@@ -106,33 +255,69 @@ class SlackBot(object):
     help_text = None
     slack_methods = None
 
-    @property
-    def _slack_client(self):
-        if self.__slack_client:
-            return self.__slack_client
-        self.__slack_client = SlackClient(self.slack_bot_token)
-        return self.__slack_client
-    __slack_client = None
-
     def __init__(self,
                  slack_bot_token,
                  slack_bot_name,
                  logger=logging.getLogger(__name__),
                  pid_file_timeout=5,
-                 polling_interval_milliseconds=100,
+                 polling_interval_milliseconds=None,
                  exception_callback=None,
-                 default_method=DefaultMethod):
+                 default_method=DefaultMethod,
+                 user_cache_ttl_seconds=600,
+                 message_batch_interval_milliseconds=None,
+                 max_workers=10,
+                 min_polling_milliseconds=50,
+                 max_polling_milliseconds=5000,
+                 bot_id_cache_path=None):
 
         self.logger = logger
         self.kill_now = False
-        self.futures = []
+        # Pending futures, kept only so that shutdown can wait for them.
+        self.futures = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Blocks the RTM loop only when every worker is busy.
+        self._slot = threading.BoundedSemaphore(max_workers)
+        self._worker_local = threading.local()
+        # Event loops created by _run_coroutine, closed once the workers have stopped.
+        self._event_loops = []
 
         self.pidfile_timeout = pid_file_timeout
 
-        self.polling_interval_milliseconds = polling_interval_milliseconds
+        if polling_interval_milliseconds is not None:
+            warnings.warn("polling_interval_milliseconds is deprecated. "
+                          "Use min_polling_milliseconds and max_polling_milliseconds instead.",
+                          DeprecationWarning, stacklevel=2)
+            min_polling_milliseconds = max_polling_milliseconds = polling_interval_milliseconds
+
+        # Used only when the RTM socket cannot be waited on: the delay starts at the minimum
+        # after an event and doubles on every empty read, up to the maximum.
+        self.min_polling_milliseconds = min_polling_milliseconds
+        self.max_polling_milliseconds = max_polling_milliseconds
+        self._polling_delay_milliseconds = min_polling_milliseconds
+
+        # Text responses to the same (channel, thread_ts) within this window are
+        # joined into one chat.postMessage. None, the default, posts every response right away.
+        self.message_batch_interval_milliseconds = message_batch_interval_milliseconds
+        self._outbox = defaultdict(list)
+        self._outbox_lock = threading.Lock()
+        self._outbox_timer = None
+        # Held for a whole flush, so only one timer posts at a time and replies stay in order.
+        self._outbox_flush_lock = threading.Lock()
 
         self.slack_bot_token = slack_bot_token
         self.slack_bot_name = slack_bot_name
+        # Does not connect until rtm_connect, so it is safe to create eagerly.
+        self._slack_client = SlackClient(slack_bot_token)
+        # Every Web API call goes through this, so bursts wait instead of hitting 429s.
+        self._rate_limited_api_call = RateLimiter(self._slack_client.api_call)
+
+        # user id -> (cached at, user name)
+        self._user_name_cache = dict()
+        # user name -> member data from users.list
+        self._users_by_name = dict()
+        self.user_cache_ttl_seconds = user_cache_ttl_seconds
+        # Optional json file that keeps the bot id across restarts. None always pages users.list.
+        self.bot_id_cache_path = bot_id_cache_path
 
         self.exception_callback = load_function(exception_callback) if exception_callback else None
 
@@ -140,42 +325,120 @@ class SlackBot(object):
         if not self.BOT_ID:
             raise Exception("Could not find bot user with the name {}.".format(self.slack_bot_name))
         self.AT_BOT = self.AT_BOT.format(self.BOT_ID)
+
+        # trigger word -> response function, built once at registration time.
+        self._trigger_index = dict()
         self.slack_methods = self._load_default_methods(default_method)
+        # re-rendered by add_method, so that `help` is an attribute read.
+        self.help_text = self._render_help_text()
 
     def get_bot_id(self):
-        api_call = self._slack_client.api_call("users.list")
-        if api_call.get('ok'):
-            # retrieve all users so we can find our bot
-            members = api_call.get('members')
+        bot_id = self._read_cached_bot_id()
+        if bot_id:
+            self.logger.info("Bot ID for '%s' is %s (cached).", self.slack_bot_name, bot_id)
+            return bot_id
+
+        self._load_users()
 
-            for member in members:
-                if 'name' in member and member.get('name') == self.slack_bot_name:
-                    self.logger.debug("Member data:{}".format(member))
-                    self.logger.info("Bot ID for '{}' is {}.".format(member['name'], member.get('id')))
+        member = self._users_by_name.get(self.slack_bot_name)
+        if member:
+            self.logger.debug("Member data:%s", member)
+            self.logger.info("Bot ID for '%s' is %s.", member['name'], member.get('id'))
 
-                    return member.get('id')
+            self._write_cached_bot_id(member.get('id'))
+            return member.get('id')
 
         return None
 
+    def _read_cached_bot_id(self):
+        if not self.bot_id_cache_path:
+            return None
+
+        try:
+            with open(self.bot_id_cache_path) as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(cached, dict) or cached.get('name') != self.slack_bot_name:
+            return None
+
+        # A bot with the same name in another workspace has another token, and another id.
+        if cached.get('token') != self._bot_id_cache_token():
+            return None
+
+        cached_at = cached.get('cached_at')
+        if not isinstance(cached_at, (int, float)) or time.time() - cached_at > BOT_ID_CACHE_TTL_SECONDS:
+            return None
+
+        bot_id = cached.get('id')
+        return bot_id if isinstance(bot_id, str) else None
+
+    def _write_cached_bot_id(self, bot_id):
+        if not self.bot_id_cache_path or not bot_id:
+            return
+
+        try:
+            with open(self.bot_id_cache_path, 'w') as cache_file:
+                json.dump({
+                    'name': self.slack_bot_name,
+                    'token': self._bot_id_cache_token(),
+                    'id': bot_id,
+                    'cached_at': time.time(),
+                }, cache_file)
+        except OSError:
+            self.logger.warning("Could not write the bot id cache to %s.", self.bot_id_cache_path, exc_info=True)
+
+    def _bot_id_cache_token(self):
+        # Only a hash of the token is written to disk.
+        return hashlib.sha256(self.slack_bot_token.encode('utf-8')).hexdigest()
+
+    def _load_users(self):
+        """
+            Pages through users.list and indexes members by name for
+            `get_bot_id`, stopping as soon as the bot is found. The same
+            pages seed the user name cache, so messages from those users
+            never need a users.info call.
+        """
+        cursor = ''
+        while True:
+            api_call = self._rate_limited_api_call("users.list", limit=USERS_LIST_PAGE_SIZE, cursor=cursor)
+            if not api_call.get('ok'):
+                return
+
+            now = time.monotonic()
+            for member in api_call.get('members'):
+                if 'name' not in member:
+                    continue
+
+                self._users_by_name[member['name']] = member
+                self._user_name_cache[member['id']] = (now, member['name'])
+
+            cursor = api_call.get('response_metadata', {}).get('next_cursor')
+            if not cursor or self.slack_bot_name in self._users_by_name:
+                return
+
     def _load_default_methods(self, default_method):
         slack_methods = dict()
 
         # add a slack method to return help message
-        slack_methods['HelpText'] = {
-            'class_name': 'HelpText',
-            'triggers': ['help', 'list'],
-            'help_text': None,
-            'response': self.get_help_text,
-        }
+        slack_methods['HelpText'] = SlackMethodEntry(
+            class_name='HelpText',
+            triggers=('help', 'list'),
+            help_text=None,
+            response=self.get_help_text,
+        )
+        self._index_triggers(slack_methods['HelpText'])
 
         # add a slack method executed when user type a wrong commands.
         wrong_input = default_method()
-        slack_methods['WrongInput'] = {
-            'class_name': 'WrongInput',
-            'triggers': wrong_input.execution_words,
-            'help_text': None,
-            'response': wrong_input.response
-        }
+        slack_methods['WrongInput'] = SlackMethodEntry(
+            class_name='WrongInput',
+            triggers=_normalize_triggers(wrong_input.execution_words),
+            help_text=None,
+            response=wrong_input.response,
+        )
+        self._index_triggers(slack_methods['WrongInput'])
 
         return slack_methods
 
@@ -183,39 +446,44 @@ class SlackBot(object):
         if issubclass(slack_method, SlackMethod):
             instance = slack_method()
 
-            if not isinstance(instance.execution_words, list):
-                raise Exception("{}.execution_words returns not a list type value. "
-                                "it must returns list.".format(slack_method.__name__))
+            if not isinstance(instance.execution_words, (list, tuple)):
+                raise Exception("{}.execution_words returns not a list or tuple type value. "
+                                "it must returns list or tuple.".format(slack_method.__name__))
 
             if slack_method in self.slack_methods:
                 raise Exception("Class name [{}] is used in two or more classes. "
                                 "It must be unique.".format(slack_method.__name__))
 
-            self.slack_methods[slack_method.__name__] = {
-                'class_name': slack_method.__name__,
-                'triggers': instance.execution_words,
-                'help_text': instance.help_text,
-                'response': instance.response,
-            }
-
-    def get_help_text(self, channel, thread_ts, user_command, request_user):
-        if self.help_text:
-            return channel, self.help_text
-
-        def _get_help_text(slack_method):
-            return '\n\t{}'.format(slack_method[1]['help_text'])
-
-        self.logger.debug(str(self.slack_methods))
-        help_text_list = list(map(
-            _get_help_text,
-            filter(
-                lambda x: isinstance(x[1]['help_text'], str),
-                self.slack_methods.items()
+            entry = SlackMethodEntry(
+                class_name=slack_method.__name__,
+                triggers=_normalize_triggers(instance.execution_words),
+                help_text=instance.help_text,
+                response=instance.response,
             )
-        ))
-        help_text_list.insert(0, '*Available commands*:\n')
-        self.help_text = ''.join(help_text_list)
+            self._index_triggers(entry)
+            self.slack_methods[entry.class_name] = entry
+
+            self.help_text = self._render_help_text()
+
+    def _index_triggers(self, entry):
+        # Check every trigger first, so a rejected method leaves nothing behind in the index.
+        for trigger in entry.triggers:
+            if trigger in self._trigger_index:
+                raise Exception("Trigger [{}] of {} is already used by {}. "
+                                "It must be unique.".format(trigger, entry.class_name,
+                                                            self._trigger_index[trigger].class_name))
+
+        for trigger in entry.triggers:
+            self._trigger_index[trigger] = entry
 
+    def _render_help_text(self):
+        return '*Available commands*:\n' + ''.join(
+            '\n\t' + slack_method.help_text
+            for slack_method in self.slack_methods.values()
+            if isinstance(slack_method.help_text, str)
+        )
+
+    def get_help_text(self, channel, thread_ts, user_command, request_user):
         return channel, thread_ts, self.help_text
 
     def run(self):
@@ -229,116 +497,220 @@ class SlackBot(object):
     def exit_gracefully(self, signum, frame):
         if signum in (signal.SIGINT, signal.SIGTERM):
             self.logger.info('Received termination signal. Prepare to exit...')
-
-            if 1 <= len(self.futures):
-                for f in as_completed(self.futures):
-                    self.logger.debug("Result of some future: {}".format(f.result()))
-
+            # Only flag the loop here; start() waits for commands and posts once the loop has returned.
             self.kill_now = True
 
         else:
-            self.logger.info('Received signal {}, but there is no process for this signal.'.format(signum))
+            self.logger.info('Received signal %s, but there is no process for this signal.', signum)
 
     def start(self):
         if self._slack_client.rtm_connect():
             self.logger.info("SlackBot connected and running!")
-            self._handle_command_loop()
+            try:
+                self._handle_command_loop()
+            finally:
+                self._shutdown()
 
         else:
             raise Exception("Connection failed. Invalid Slack token or bot ID?")
 
         return True
 
+    def _shutdown(self):
+        if 1 <= len(self.futures):
+            self.logger.info('Waiting for %d running command(s)...', len(self.futures))
+            for _ in as_completed(list(self.futures)):
+                pass
+
+        self._executor.shutdown(wait=True)
+        for loop in self._event_loops:
+            loop.close()
+        self._drain_outbox()
+
     def _handle_command_loop(self):
         while True:
             if self.kill_now:
                 return
-            # Max sub processes count is 5.
-            if len(self.futures) >= 5:
-                for f in as_completed(self.futures):
-                    self.logger.info("Result of some future: " + str(f.result()))
-                self.futures = list()
-
             try:
-                channel, thread_ts, command, user = self._parse_slack_output(self._slack_client.rtm_read())
+                if not self._wait_for_rtm_event():
+                    continue
 
-                if channel and command and user:
-                    self._handle_command(channel, thread_ts, command, user)
+                rtm_output = self._slack_client.rtm_read()
+                if rtm_output:
+                    self._polling_delay_milliseconds = self.min_polling_milliseconds
+                else:
+                    # max(..., 1) lets a zero minimum still grow.
+                    self._polling_delay_milliseconds = min(max(self._polling_delay_milliseconds * 2, 1),
+                                                           self.max_polling_milliseconds)
+
+                for channel, thread_ts, command, user in self._parse_slack_output(rtm_output):
+                    if channel and command and user:
+                        self._handle_command(channel, thread_ts, command, user)
 
             except KeyboardInterrupt:
                 e = sys.exc_info()[1]
 
                 raise e
 
+            except RTM_CONNECTION_ERRORS as e:
+                self.logger.warning("Lost the RTM connection, reconnecting. exception: %s", e)
+
+                if self._reconnect():
+                    continue
+
+                if self.kill_now:
+                    # Shut down by a signal while backing off; not a failure to report.
+                    return
+
+                self.logger.error("Could not reconnect to Slack. Invalid or revoked Slack token?")
+
+                if self.exception_callback:
+                    self.exception_callback(e)
+
+                self.exit_gracefully(signal.SIGTERM, None)
+
             except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                error_traceback = 'Exception traceback: {}'.format(
-                    ''.join(
-                        str(entry) for entry in traceback.format_tb(exc_traceback, limit=20)
-                    )
-                )
-                self.logger.exception("Caught exception when handle command loop. exception: {}".format(e))
-                self.logger.exception(error_traceback)
+                # logger.exception attaches the traceback itself, and only formats it when emitted.
+                self.logger.exception("Caught exception when handle command loop. exception: %s", e)
 
                 if self.exception_callback:
                     self.exception_callback(e)
 
                 self.exit_gracefully(signal.SIGTERM, None)
 
-            if self.polling_interval_milliseconds is not None:
-                time.sleep(self.polling_interval_milliseconds / 1000)
+    def _reconnect(self):
+        """
+            Reconnects to RTM with exponential backoff and jitter, for as
+            long as the failure looks transient.
+        Returns:
+            (bool): False when the token was rejected or the bot is exiting.
+        """
+        attempt = 0
+        while not self.kill_now:
+            time.sleep(min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_BASE * 2 ** attempt) + random.uniform(0, 1))
+
+            if self._slack_client.rtm_connect():
+                self.logger.info("SlackBot reconnected after %d failed attempt(s).", attempt)
+                return True
+
+            # rtm_connect returns False for any failure, so ask Slack whether the token is still good.
+            try:
+                auth_error = self._rate_limited_api_call('auth.test').get('error')
+
+            except Exception:
+                auth_error = None
+
+            if auth_error in UNRECOVERABLE_AUTH_ERRORS:
+                return False
+
+            attempt += 1
+
+        return False
+
+    def _wait_for_rtm_event(self, timeout=1.0):
+        """
+            Sleeps until the RTM websocket has something to read, so an idle
+            bot does not keep waking up to poll `rtm_read`. The timeout keeps
+            the loop checking `kill_now` regularly.
+        Args:
+            timeout (float): Maximum seconds to wait.
+
+        Returns:
+            (bool): Whether `rtm_read` should be called.
+        """
+        websocket = getattr(self._slack_client.server, 'websocket', None)
+        sock = getattr(websocket, 'sock', None)
+
+        if sock is None:
+            # Fall back to polling when the socket is not exposed.
+            time.sleep(self._polling_delay_milliseconds * random.uniform(0.8, 1.2) / 1000)
+            return True
+
+        # rtm_read only reads one frame; the rest of a TLS record it decrypted stays
+        # in the SSL buffer, where select on the raw socket cannot see it.
+        if getattr(sock, 'pending', lambda: 0)():
+            return True
+
+        readable, _, _ = select.select([sock], [], [], timeout)
+        return bool(readable)
 
     def _parse_slack_output(self, slack_rtm_output):
         """
             The Slack Real Time Messaging API is an events firehose.
-            this parsing function returns None unless a message is
-            directed at the Bot, based on its ID.
+            this parsing function yields every message in the batch
+            that is directed at the Bot, based on its ID.
         Args:
             slack_rtm_output:
 
-        Returns:
+        Yields:
             channel (str): Channel with requested user.
+            thread_ts (str): Thread of the message or None.
             text (str): Received message from user.
             user (str): Mention of user who triggered command.
         """
-        output_list = slack_rtm_output
+        at_bot = self.AT_BOT
+        bot_id = self.BOT_ID
+
+        for output in slack_rtm_output or ():
+            # Most of the firehose is not a message at all, so check that first
+            # and skip the event instead of dropping the rest of the batch.
+            if not isinstance(output, dict) or output.get('type') != 'message':
+                continue
+
+            # Never answer the bot's own messages, e.g. a reply that quotes the mention.
+            if output.get('user') == bot_id:
+                continue
 
-        if output_list and len(output_list) > 0:
-            for output in output_list:
-                if not isinstance(output, dict):
-                    return None, None, None, None
+            try:
+                # return text after the @ mention, whitespace removed
+                _, mentioned, command = output['text'].partition(at_bot)
+                if not mentioned:
+                    continue
+
+                channel = output['channel']
+                user_id = output['user']
 
-                if 'channel' not in output:
-                    return None, None, None, None
+            except KeyError:
+                continue
 
-                if output['type'] != 'message':
-                    return None, None, None, None
+            # self.logger.debug('SlackRUMOutput:{}'.format(output))
+            user_name = self._resolve_user_name(user_id)
 
-                if 'text' in output and self.AT_BOT in output['text']:
-                    # return text after the @ mention, whitespace removed
-                    # self.logger.debug('SlackRUMOutput:{}'.format(output))
-                    user = self._slack_client.server.users[output['user']]
+            self.logger.info('%s', output)
+
+            yield (
+                channel,
+                output.get('thread_ts', None),
+                command.strip(),
+                user_name,
+            )
 
-                    self.logger.info(str(output))
+            # elif 'message' == output['type']:
+                # _response = self._slack_client.api_call('im.list')
+                # if not _response.get('ok'):
+                #     return None, None
+                # self.logger.debug('im.list ok response:{}'.format(_response))
+                # for im in _response['ims']:
+                #     if output['channel'] == im['id']:
+                #         return output['channel'], output['text'].strip().lower()
+                # self.logger.debug('SlackRUMOutput:{}'.format(output))
+
+    def _resolve_user_name(self, user_id):
+        now = time.monotonic()
+        cached = self._user_name_cache.get(user_id)
+        if cached and now - cached[0] < self.user_cache_ttl_seconds:
+            return cached[1]
 
-                    return (
-                        output.get('channel'),
-                        output.get('thread_ts', None),
-                        output['text'].split(self.AT_BOT)[1].strip(),
-                        '{}'.format(user.name),
-                    )
+        try:
+            user_name = self._slack_client.server.users[user_id].name
 
-                # elif 'message' == output['type']:
-                    # _response = self._slack_client.api_call('im.list')
-                    # if not _response.get('ok'):
-                    #     return None, None
-                    # self.logger.debug('im.list ok response:{}'.format(_response))
-                    # for im in _response['ims']:
-                    #     if output['channel'] == im['id']:
-                    #         return output['channel'], output['text'].strip().lower()
-                    # self.logger.debug('SlackRUMOutput:{}'.format(output))
+        except KeyError:
+            # The user joined after rtm.connect, so ask Slack once and cache the answer.
+            api_call = self._rate_limited_api_call('users.info', user=user_id)
+            user_name = api_call.get('user', {}).get('name', user_id)
 
-        return None, None, None, None
+        self._user_name_cache[user_id] = (now, user_name)
+        return user_name
 
     def _handle_command(self, channel, thread_ts, command, request_user):
         """
@@ -354,27 +726,51 @@ class SlackBot(object):
         Returns:
 
         """
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            params = {
-                'callback': self._slack_client.api_call,
-                'channel': channel,
-                'thread_ts': thread_ts,
-                'func': self._get_command_function(command),
-                'user_command': command,
-                'request_user': request_user
-            }
+        slack_method = self._get_slack_method(command)
+        params = {
+            'callback': self._rate_limited_api_call,
+            'channel': channel,
+            'thread_ts': thread_ts,
+            'func': slack_method.response,
+            'user_command': command,
+            'request_user': request_user
+        }
+
+        self._slot.acquire()
+        if self.kill_now:
+            # Shutting down while waiting for a worker; the executor may already be gone.
+            self._slot.release()
+            self.logger.info('Dropped a command from %s, the bot is exiting.', request_user)
+            return
+
+        future = self._executor.submit(self._command_executor, **params)
+        self.futures.add(future)
+        future.add_done_callback(self._on_command_done)
+
+    def _on_command_done(self, future):
+        try:
+            self.futures.discard(future)
+
+            # Raising from a done callback would only reach the concurrent.futures logger.
+            exc = None if future.cancelled() else future.exception()
+            if exc is not None:
+                self.logger.error("Caught exception when running a command. exception: %s", exc, exc_info=exc)
+
+                if self.exception_callback:
+                    self.exception_callback(exc)
 
-            future = executor.submit(self._command_executor, **params)
-            self.futures.append(future)
+        finally:
+            self._slot.release()
 
     def _command_executor(self, callback, channel, func, user_command, request_user, thread_ts=None):
         try:
-            channel, thread_ts, response = func(channel, thread_ts, user_command, request_user=request_user)
+            result = func(channel, thread_ts, user_command, request_user=request_user)
+            if asyncio.iscoroutine(result):
+                result = self._run_coroutine(result)
 
-        except Exception as e:
-            self.logger.error('An error occurred in a {} function. exception:{}'.format(func, e))
+            channel, thread_ts, response = result
 
-            trace_formatted = traceback.format_exc()
+        except Exception as e:
             extra_data = {
                 'callback': callback,
                 'channel': channel,
@@ -384,31 +780,104 @@ class SlackBot(object):
                 'thread_ts': thread_ts,
             }
             extra_data_formatted = '\n'.join('{}: {}'.format(k, v) for k, v in extra_data.items())
-            error_message = '{}\n{}\n{}'.format(trace_formatted, '-' * 70, extra_data_formatted)
+            self.logger.exception('An error occurred in a %s function. exception: %s\n%s',
+                                  func, e, extra_data_formatted)
+
+            # Only the innermost frames go to Slack; the log above has the full traceback.
+            frames = traceback.extract_tb(e.__traceback__)[-MAX_ERROR_TRACEBACK_FRAMES:]
+            error_message = 'Traceback (most recent call last):\n{}{}\n{}\n{}'.format(
+                ''.join(traceback.format_list(frames)),
+                ''.join(traceback.format_exception_only(type(e), e)),
+                '-' * 70,
+                extra_data_formatted,
+            )
+            if len(error_message) > MAX_ERROR_MESSAGE_LENGTH:
+                # Keep the end of the message: the innermost frames and the extra data.
+                error_message = '...' + error_message[-MAX_ERROR_MESSAGE_LENGTH:]
+
+            channel, thread_ts, response = self.slack_methods['WrongInput'].response(
+                channel, thread_ts, user_command, request_user, exception=error_message)
 
-            self.logger.error(error_message)
+        is_blocks = isinstance(response, list)
 
-            channel, response = self.slack_methods['WrongInput']['response'](channel, user_command,
-                                                                             exception=error_message)
+        if is_blocks and response and all(isinstance(text, str) for text in response):
+            # Several sections go out as one message instead of one post per section.
+            response = [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': text}} for text in response]
+
+        message = response if is_blocks else str(response)
+
+        if self.message_batch_interval_milliseconds is not None:
+            # The outbox timer posts it, so this worker is free for the next command right away.
+            self._enqueue_message(callback, channel, thread_ts, message)
+            return
 
         post_message_args = {'channel': channel, 'thread_ts': thread_ts, 'as_user': True}
 
-        if isinstance(response, list):
-            post_message_args['blocks'] = response
+        if is_blocks:
+            post_message_args['blocks'] = message
 
         else:
-            post_message_args['text'] = str(response)
+            post_message_args['text'] = message
 
         callback("chat.postMessage", **post_message_args)
 
         return
 
-    def _get_command_function(self, command):
-        for method_name in self.slack_methods:
-            slack_method = self.slack_methods[method_name]
+    def _run_coroutine(self, coroutine):
+        # One event loop per worker thread, reused across commands.
+        loop = getattr(self._worker_local, 'loop', None)
+        if loop is None:
+            loop = self._worker_local.loop = asyncio.new_event_loop()
+            self._event_loops.append(loop)
+
+        return loop.run_until_complete(coroutine)
+
+    def _enqueue_message(self, callback, channel, thread_ts, message):
+        with self._outbox_lock:
+            self._outbox[(channel, thread_ts)].append(message)
+
+            if self._outbox_timer is None:
+                self._outbox_timer = threading.Timer(self.message_batch_interval_milliseconds / 1000,
+                                                     self._flush_outbox, args=(callback,))
+                self._outbox_timer.daemon = True
+                self._outbox_timer.start()
+
+    def _flush_outbox(self, callback):
+        with self._outbox_flush_lock:
+            with self._outbox_lock:
+                outbox, self._outbox = self._outbox, defaultdict(list)
+                self._outbox_timer = None
+
+            for (channel, thread_ts), messages in outbox.items():
+                # Consecutive texts are joined into one post; blocks are posted one by one, in order.
+                for is_blocks, group in itertools.groupby(messages, key=lambda message: isinstance(message, list)):
+                    if is_blocks:
+                        for blocks in group:
+                            self._post_message(callback, channel, thread_ts, blocks=blocks)
+
+                    else:
+                        self._post_message(callback, channel, thread_ts, text='\n'.join(group))
+
+    def _post_message(self, callback, channel, thread_ts, **content):
+        try:
+            callback("chat.postMessage", channel=channel, thread_ts=thread_ts, as_user=True, **content)
+
+        except Exception as e:
+            self.logger.exception('Failed to post a message to %s. exception: %s', channel, e)
+
+    def _drain_outbox(self):
+        with self._outbox_lock:
+            timer = self._outbox_timer
 
-            for trigger in slack_method['triggers']:
-                if isinstance(trigger, str) and str(command).strip().split(' ')[0].strip() == str(trigger).strip():
-                    return self.slack_methods[method_name]['response']
+        if timer is not None:
+            timer.cancel()
+            self._flush_outbox(*timer.args)
+
+        else:
+            # A timer may have taken the outbox already; wait until it has posted everything.
+            with self._outbox_flush_lock:
+                pass
 
-        return self.slack_methods['WrongInput']['response']
+    def _get_slack_method(self, command):
+        first_word = command.strip().partition(' ')[0].lower()
+        return self._trigger_index.get(first_word, self.slack_methods['WrongInput'])
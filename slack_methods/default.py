@@ -3,13 +3,9 @@ from slaccato.core import SlackMethod
 
 class DefaultResponse(SlackMethod):
 
-    @property
-    def execution_words(self):
-        return ['할수없음']
+    execution_words = ('할수없음',)
 
-    @property
-    def help_text(self):
-        return None
+    help_text = None
 
     def response(self, channel, user_command, exception=None, pbot_log_pk=None):
         if not exception:
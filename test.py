@@ -1,18 +1,67 @@
+import atexit
+import io
 import logging
-from sys import stdout
+import logging.handlers
+import queue
+import sys
 
 from slack_methods.test import TestResponse
 from slaccato.core import SlackBot
 
+
+class BufferedBytesHandler(logging.Handler):
+    """Writes records as utf-8 bytes to a buffered binary stream. Only errors are flushed right away."""
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+
+    def emit(self, record):
+        try:
+            self.stream.write((self.format(record) + '\n').encode('utf-8', 'replace'))
+            if record.levelno >= logging.ERROR:
+                self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+
+# The harness never prints process, thread or multiprocessing names, so skip collecting them.
+logging.logProcesses = False
+logging.logThreads = False
+logging.logMultiprocessing = False
+logging.raiseExceptions = False
+
 logger = logging.getLogger(__name__)
 
-logger.setLevel(4)
-logger.addHandler(logging.StreamHandler(stdout))
+# Use logging.DEBUG while developing a method; it logs every RTM event.
+logger.setLevel(logging.INFO)
+# Buffer log output so every record is not its own write() to stdout.
+log_stream = io.BufferedWriter(sys.stdout.buffer, buffer_size=65536)
+atexit.register(log_stream.flush)
+stream_handler = BufferedBytesHandler(log_stream)
+# Messages only, so records are not timestamped with localtime/strftime.
+stream_handler.setFormatter(logging.Formatter('%(message)s'))
+# Hand records to the stream in batches of up to 512, or right away on an error.
+memory_handler = logging.handlers.MemoryHandler(
+    capacity=512,
+    flushLevel=logging.ERROR,
+    target=stream_handler,
+)
+# atexit runs in reverse order, so this flushes into the stream before the stream is flushed.
+atexit.register(memory_handler.flush)
+# Worker threads only put records on the queue; the listener thread does the handling and writing.
+log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, memory_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 slack_bot = SlackBot(
     slack_bot_token='SLACK_BOT_TOKEN',
-    slack_bot_name='SLACK_BOT_NAME'
-    logger=logger
+    slack_bot_name='SLACK_BOT_NAME',
+    logger=logger,
+    # Responses run on this many worker threads, so the RTM loop keeps reading.
+    max_workers=8,
 )
 
 slack_bot.add_method(TestResponse)